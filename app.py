@@ -1,11 +1,18 @@
+import io
 import os
-import json
+import uuid
+import orjson
 import pandas as pd
 import streamlit as st
 import altair as alt
-from sqlalchemy import create_engine, text
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.json as paj
+import connectorx as cx
+from sqlalchemy import make_url, text
+from sqlalchemy.dialects import postgresql
 from dotenv import load_dotenv
-from datetime import datetime, time
+from datetime import datetime, time, timedelta
 
 # -----------------------
 # Load secrets
@@ -13,61 +20,210 @@ from datetime import datetime, time
 load_dotenv()
 DATABASE_psy = os.getenv("DATABASE_psy")
 
-engine = create_engine(DATABASE_psy)
+# connectorx wants a plain postgresql:// URL, without the SQLAlchemy driver suffix
+CX_URL = make_url(DATABASE_psy).set(drivername="postgresql").render_as_string(hide_password=False)
+
+# connectorx has no bind params, so filter values are rendered as SQL literals
+PG_DIALECT = postgresql.dialect(paramstyle="named")
+
 
 # -----------------------
 # Helpers
 # -----------------------
+# Columns read from the leads table besides the flattened answers
+LEAD_COLUMNS = ["id", "form_id", "created_time"]
+
+# Meta answers are stored as [{"name": ..., "values": [...]}, ...]; collapse
+# them into one {name: value} object per lead inside Postgres so only the
+# flattened answers come over the wire, in the form's field order.
+ANSWERS_SQL = """
+    SELECT json_object_agg(
+               COALESCE(NULLIF(elem->>'name', ''), elem->>'key'),
+               CASE WHEN jsonb_typeof(elem->'values') = 'array'
+                         AND jsonb_array_length(elem->'values') = 1
+                    THEN elem->'values'->0
+                    ELSE elem->'values'
+               END
+               ORDER BY n
+           )
+    FROM jsonb_array_elements(
+             CASE WHEN jsonb_typeof(to_jsonb(l.answers)) = 'array'
+                  THEN to_jsonb(l.answers)
+                  ELSE '[]'::jsonb
+             END
+         ) WITH ORDINALITY AS e(elem, n)
+    WHERE COALESCE(NULLIF(elem->>'name', ''), elem->>'key') IS NOT NULL
+"""
+
+# Answers held as JSON text (a text column or a jsonb string) can't be cast in
+# SQL without one malformed row failing the whole query, so they go out as text
+# and flatten_answers decodes them per lead
+ANSWERS_TEXT_SQL = """
+    CASE WHEN jsonb_typeof(to_jsonb(l.answers)) = 'string'
+         THEN to_jsonb(l.answers) #>> '{}'
+    END
+"""
+
+
 def flatten_answers(raw):
-    """Convert Meta answers JSON into flat dict"""
-    if not raw:
-        return {}
-    if isinstance(raw, str):
-        try:
-            raw = json.loads(raw)
-        except Exception:
-            return {}
+    """Convert Meta answers JSON text into the {name: value} JSON ANSWERS_SQL builds"""
+    try:
+        items = orjson.loads(raw)
+    except orjson.JSONDecodeError:
+        return "{}"
     flat = {}
-    for item in raw:
-        field = item.get("name") or item.get("key")
-        value = item.get("values")
-        if isinstance(value, list) and len(value) == 1:
-            value = value[0]
-        flat[field] = value
-    return flat
+    if isinstance(items, list):
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            field = item.get("name") or item.get("key")
+            if field is None:
+                continue
+            value = item.get("values")
+            if isinstance(value, list) and len(value) == 1:
+                value = value[0]
+            flat[str(field)] = value
+    return orjson.dumps(flat).decode()
+
+
+def bind_params(sql, params):
+    """Render params into sql as quoted literals, without a database round trip"""
+    query = text(sql).bindparams(**params)
+    return str(query.compile(dialect=PG_DIALECT, compile_kwargs={"literal_binds": True}))
+
+
+def without_timestamps(typ):
+    """typ with every timestamp, however deeply nested, replaced by string"""
+    if pa.types.is_timestamp(typ):
+        return pa.string()
+    if pa.types.is_list(typ):
+        return pa.list_(without_timestamps(typ.value_type))
+    if pa.types.is_struct(typ):
+        return pa.struct([field.with_type(without_timestamps(field.type)) for field in typ])
+    return typ
+
+
+def expand_answers(answers, index):
+    """Turn the per-lead answers JSON text into one answer_* column per field"""
+    # Leads without answers come back NULL; join the column into one NDJSON
+    # buffer inside Arrow so its multithreaded C++ reader parses every lead
+    lines = pc.fill_null(answers, "{}").cast(pa.large_string()).combine_chunks()
+    ndjson = pc.binary_join(
+        pa.ListArray.from_arrays([0, len(lines)], lines), pa.scalar("\n", pa.large_string())
+    )[0].as_buffer()
+    try:
+        parsed = paj.read_json(pa.BufferReader(ndjson))
+        # read_json turns ISO-looking strings into timestamps, also inside
+        # multi-select lists; read those fields again as the strings Meta sent
+        dates = [
+            field.with_type(without_timestamps(field.type))
+            for field in parsed.schema
+            if without_timestamps(field.type) != field.type
+        ]
+        if dates:
+            as_text = paj.ParseOptions(explicit_schema=pa.schema(dates))
+            parsed = paj.read_json(pa.BufferReader(ndjson), parse_options=as_text).select(parsed.column_names)
+        columns = {}
+        for name, col in zip(parsed.column_names, parsed.columns):
+            if pa.types.is_list(col.type) or pa.types.is_struct(col.type):
+                # Multi-select answers stay Python lists (missing as NaN), as in
+                # the per-row path
+                values = [float("nan") if value is None else value for value in col.to_pylist()]
+                columns[name] = pd.Series(values, index=index, dtype=object)
+            else:
+                columns[name] = pd.Series(pd.arrays.ArrowExtensionArray(col), index=index)
+        expanded = pd.DataFrame(columns, index=index)
+    except pa.ArrowInvalid:
+        # A field mixing strings and multi-select lists has no single Arrow
+        # type (or there are no rows at all); decode per row instead
+        flat = [orjson.loads(raw) for raw in lines.to_pylist()]
+        expanded = pd.DataFrame(flat, index=index).convert_dtypes(dtype_backend="pyarrow")
 
+    # Add prefix to avoid duplicates
+    return expanded.add_prefix("answer_")
 
-@st.cache_data(ttl=300)
+
+@st.cache_data(ttl=300, max_entries=64)
 def load_leads(form_id=None, start_date=None, end_date=None):
+    """Return the filtered leads and a token identifying this particular load"""
     filters = ["1=1"]
     params = {}
 
     if form_id:
+        # Rendered into the SQL as a literal, so only accept Meta's numeric IDs
+        if not (form_id.isascii() and form_id.isdigit()):
+            raise ValueError(f"form_id must be numeric, got {form_id!r}")
         filters.append("form_id = :form_id")
         params["form_id"] = form_id
     if start_date:
         filters.append("created_time >= :start_date")
         params["start_date"] = datetime.combine(start_date, time.min)
     if end_date:
-        filters.append("created_time <= :end_date")
-        params["end_date"] = datetime.combine(end_date, time.max)
+        # Half-open bound on the next midnight instead of 23:59:59.999999
+        filters.append("created_time < :end_date_plus_1")
+        params["end_date_plus_1"] = datetime.combine(end_date + timedelta(days=1), time.min)
+
+    # Answers go out as text: connectorx re-serializes json with sorted keys
+    columns = ", ".join(f"l.{col}" for col in LEAD_COLUMNS)
+    query = (
+        f"SELECT {columns}, ({ANSWERS_SQL})::text AS answers, "
+        f"{ANSWERS_TEXT_SQL} AS answers_text "
+        f"FROM leads l WHERE {' AND '.join(filters)}"
+    )
 
-    query = text(f"SELECT * FROM leads WHERE {' AND '.join(filters)}")
+    # Arrow straight off the wire; stay columnar until the pandas handoff
+    tbl = cx.read_sql(CX_URL, bind_params(query, params), return_type="arrow")
 
-    df = pd.read_sql(query, engine, params=params)
+    # Pull answers out in Arrow so pandas only ever sees the flat columns
+    answers = None
+    if "answers" in tbl.column_names:
+        # Already flattened server-side, one JSON object text per lead
+        answers = tbl.column("answers")
+        answers_text = tbl.column("answers_text")
+        if answers_text.null_count < len(answers_text):
+            # JSON-text answers are decoded per lead; malformed ones yield {}
+            merged = [
+                flat if raw is None else flatten_answers(raw)
+                for flat, raw in zip(answers.to_pylist(), answers_text.to_pylist())
+            ]
+            answers = pa.chunked_array([pa.array(merged, pa.string())])
+        tbl = tbl.drop_columns(["answers", "answers_text"])
+
+    df = tbl.to_pandas(types_mapper=pd.ArrowDtype)
 
     # Ensure datetime conversion
     if "created_time" in df.columns:
         df["created_time"] = pd.to_datetime(df["created_time"], errors="coerce")
 
     # Flatten answers and avoid duplicate columns
-    if "answers" in df.columns:
-        expanded = df["answers"].apply(flatten_answers).apply(pd.Series)
-        # Add prefix to avoid duplicates
-        expanded = expanded.add_prefix("answer_")
-        df = pd.concat([df.drop(columns=["answers"]), expanded], axis=1)
+    if answers is not None:
+        expanded = expand_answers(answers, df.index)
+        # Attach column by column; a concat would build and reblock a new frame
+        for col in expanded.columns:
+            df[col] = expanded[col].array
+
+    return df, uuid.uuid4().hex
+
 
-    return df
+# The export caches take the frame as _df so Streamlit doesn't hash it
+# (multi-select list columns can't be hashed, so it would pickle the whole
+# thing); the load_id load_leads returned with it keys the cache instead, so
+# an export always matches the frame on screen.
+@st.cache_data(ttl=300, max_entries=16)
+def df_to_csv_bytes(_df: pd.DataFrame, load_id: str) -> bytes:
+    buf = io.BytesIO()
+    _df.to_csv(buf, index=False, encoding="utf-8")
+    return buf.getvalue()
+
+
+@st.cache_data(ttl=300, max_entries=16)
+def df_to_parquet_bytes(_df: pd.DataFrame, load_id: str) -> bytes:
+    # Multi-select answers leave lists next to strings; Parquet needs one type
+    obj_cols = _df.select_dtypes("object").columns
+    df = _df.astype({col: "string[pyarrow]" for col in obj_cols})
+    buf = io.BytesIO()
+    df.to_parquet(buf, index=False, compression="zstd")
+    return buf.getvalue()
 
 
 # -----------------------
@@ -78,34 +234,52 @@ st.title("📊 Meta Lead Ads Dashboard")
 
 with st.sidebar:
     st.header("Filters")
-    form_id = st.text_input("Form ID (optional)")
+    form_id = st.text_input("Form ID (optional)").strip()
     start_date = st.date_input("Start date")
     end_date = st.date_input("End date")
 
-df = load_leads(form_id or None, start_date or None, end_date or None)
+if form_id and not (form_id.isascii() and form_id.isdigit()):
+    st.error("Form ID must be numeric.")
+    st.stop()
+
+df, load_id = load_leads(form_id or None, start_date or None, end_date or None)
 
 st.subheader("Raw Leads")
 st.dataframe(df, use_container_width=True)
 
 # CSV export
 if not df.empty:
-    csv = df.to_csv(index=False).encode("utf-8")
+    csv = df_to_csv_bytes(df, load_id)
     st.download_button(
         label="⬇️ Download Leads as CSV",
         data=csv,
         file_name="leads.csv",
         mime="text/csv",
     )
+    st.download_button(
+        label="⬇️ Download Leads as Parquet",
+        data=df_to_parquet_bytes(df, load_id),
+        file_name="leads.parquet",
+        mime="application/octet-stream",
+    )
 
-    # Leads over time chart
+    # Leads over time chart, aggregated here so only one row per day is sent
     if "created_time" in df.columns:
+        # Bucket by UTC day and label with a UTC time unit, so Vega doesn't
+        # shift the midnights into the viewer's timezone
+        daily = (
+            df.assign(day=pd.to_datetime(df["created_time"], utc=True).dt.floor("D"))
+            .groupby("day", dropna=False)
+            .size()
+            .reset_index(name="leads")
+        )
         chart = (
-            alt.Chart(df)
+            alt.Chart(daily)
             .mark_bar()
             .encode(
-                x="yearmonthdate(created_time):O",
-                y="count()",
-                tooltip=["count()"]
+                x="utcyearmonthdate(day):O",
+                y="leads:Q",
+                tooltip=["leads:Q"]
             )
             .properties(title="Leads over Time", width=800)
         )
@@ -114,13 +288,14 @@ if not df.empty:
     # Breakdown by form_id
     if "form_id" in df.columns:
         st.subheader("Leads by Form ID")
+        by_form = df["form_id"].value_counts(dropna=False).reset_index(name="leads")
         form_chart = (
-            alt.Chart(df)
+            alt.Chart(by_form)
             .mark_bar()
             .encode(
                 x="form_id:O",
-                y="count()",
-                tooltip=["count()"]
+                y="leads:Q",
+                tooltip=["leads:Q"]
             )
         )
         st.altair_chart(form_chart, use_container_width=True)